@@ -10,15 +10,27 @@ My fan is a Waveshare, part number: CM4-FAN-3007-12V and the
 practical Fan Speed Range (found empirically) is between between 45 (18%) and 255 (100%).
 The fastest speed while remaining quiet is about 70 (27%).
 """
+import asyncio
+import atexit
+import contextlib
+import ctypes
+import fcntl
 import logging
 import os
-import re
+import shutil
 import subprocess
 import sys
 import time
-from typing import List
+from bisect import bisect_left, bisect_right
+from itertools import accumulate, pairwise
+from typing import Any, Tuple
 
-import smbus  # pylint: disable=import-error
+try:
+    # pylint: disable=import-error
+    from cffi import FFI  # type: ignore[import-not-found,import-untyped]
+except ImportError:
+    # cffi is optional
+    FFI = None
 
 # Hysteresis: 2 degrees?
 # So if the trigger for point 4 is 70 degrees
@@ -31,39 +43,178 @@ LOGGING_LEVEL: str = os.environ.get("LOGGING_LEVEL", "INFO")
 
 MEASUREMENT_INTERVAL_S: int = int(os.environ.get("MEASUREMENT_INTERVAL_S", "8"))
 
-# The 4 temperature point,
+# A tuple of the 4 temperature points (degrees Celsius),
 # These values define the temperature values for the fan speed bands.
-TEMPERATURE_POINT_1: int = int(os.environ.get("TEMPERATURE_POINT_1", "40"))
-TEMPERATURE_POINT_2: int = int(os.environ.get("TEMPERATURE_POINT_1", "60"))
-TEMPERATURE_POINT_3: int = int(os.environ.get("TEMPERATURE_POINT_1", "65"))
-TEMPERATURE_POINT_4: int = int(os.environ.get("TEMPERATURE_POINT_1", "70"))
+# They're read (and parsed) once, like everything else in the environment.
+TEMPERATURE_POINTS: Tuple[int, ...] = (
+    int(os.environ.get("TEMPERATURE_POINT_1", "40")),
+    int(os.environ.get("TEMPERATURE_POINT_2", "60")),
+    int(os.environ.get("TEMPERATURE_POINT_3", "65")),
+    int(os.environ.get("TEMPERATURE_POINT_4", "70")),
+)
 
 # A tuple of 5 band speeds (as a percent of full speed).
-BAND_SPEED: List[int] = [
+BAND_SPEED: Tuple[int, ...] = (
     int(os.environ.get("BAND_0_SPEED", "0")),
     int(os.environ.get("BAND_1_SPEED", "25")),
     int(os.environ.get("BAND_2_SPEED", "50")),
     int(os.environ.get("BAND_3_SPEED", "75")),
     int(os.environ.get("BAND_4_SPEED", "100")),
-]
+)
 HIGHEST_BAND: int = len(BAND_SPEED) - 1
 
+# The sysfs thermal zone file (the CPU temperature in milli-degrees Celsius).
+# If it's not available we fall back to 'vcgencmd'.
+CPU_TEMPERATURE_FILE: str = "/sys/class/thermal/thermal_zone0/temp"
+# The (absolute) path to 'vcgencmd', found once (or None if it's not installed)
+# so there's no PATH search when we run it.
+VCGENCMD: str | None = shutil.which("vcgencmd")
+
 # Hardware details of the fan controller
 # Bus ID of 10 implies the device /dev/i2c-10 (port I2C10)
 BUS_ID: int = 10
 DEGREE_SIGN: str = "\N{DEGREE SIGN}"
 FAN_ADDR = 0x2F
 FAN_CONTROL_COMMAND = 0x30
+# The I2C_RDWR ioctl request (from linux/i2c-dev.h)
+# and the I2C message 'read' flag (from linux/i2c.h)
+I2C_RDWR: int = 0x0707
+I2C_M_RD: int = 0x0001
 MINIMUM_TEMPERATURE_POINT_VALUE: int = 30
 MINIMUM_FAN_SPEED_PERCENT: int = 0
 MINIMUM_INTERVAL_S: int = 4
 MAXIMUM_INTERVAL_S: int = 60
+# Adapting the measurement interval.
+# The interval depends on the band - a cool system (i.e. band 0)
+# needs measuring less often than a hot one (BAND_INTERVAL_FACTOR
+# scales MEASUREMENT_INTERVAL_S for each band). By default a steady
+# temperature is measured every 32, 16, 8 and 4 seconds in bands 0 to 3,
+# and every 4 seconds (the minimum) in band 4.
+# We measure more often when the temperature is changing quickly
+# (by more than UNSTABLE_TEMPERATURE_CHANGE_MC between measurements)
+# or is within NEAR_THRESHOLD_MC of a threshold.
+UNSTABLE_TEMPERATURE_CHANGE_MC: int = 3000
+NEAR_THRESHOLD_MC: int = 2000
+BAND_INTERVAL_FACTOR: Tuple[float, ...] = (4.0, 2.0, 1.0, 0.5, 0.25)
+
+
+class FanState:  # pylint: disable=too-few-public-methods
+    """The controller's (mutable) state.
+    Slots keep the attributes out of a dictionary (and the object small).
+    """
+
+    __slots__ = ("band", "last_raw", "temp_mc", "temp_raw", "temp_raw_mc")
+
+    def __init__(self) -> None:
+        # A record of the current fan speed band
+        self.band: int = 0
+        # A record of the last (raw) speed written to the fan controller
+        # (-1 until the first write)
+        self.last_raw: int = -1
+        # The last measured temperature (milli-degrees Celsius)
+        self.temp_mc: int | None = None
+        # The last (raw) content read from the temperature file
+        # and its (parsed) value, so it's only parsed when it changes
+        # (None until a read has been parsed, as any content can be read)
+        self.temp_raw: bytes | None = None
+        self.temp_raw_mc: int = 0
+
+
+STATE: FanState = FanState()
+
+
+class I2cMsg(ctypes.Structure):  # pylint: disable=too-few-public-methods
+    """An I2C message, the 'i2c_msg' structure from linux/i2c.h."""
 
-# A record of the current fan speed band
-CURRENT_BAND: int = 0
+    _fields_ = [
+        ("addr", ctypes.c_uint16),
+        ("flags", ctypes.c_uint16),
+        ("len", ctypes.c_uint16),
+        ("buf", ctypes.POINTER(ctypes.c_uint8)),
+    ]
 
-# Create the I2C bus object
-SMBUS = smbus.SMBus(BUS_ID)
+
+class I2cRdwrIoctlData(ctypes.Structure):  # pylint: disable=too-few-public-methods
+    """The I2C_RDWR ioctl argument,
+    the 'i2c_rdwr_ioctl_data' structure from linux/i2c-dev.h.
+    """
+
+    _fields_ = [
+        ("msgs", ctypes.POINTER(I2cMsg)),
+        ("nmsgs", ctypes.c_uint32),
+    ]
+
+
+def close_i2c_bus() -> None:
+    """Closes the I2C bus (device)."""
+    # It may already be unusable, and there's nothing we can do about it
+    with contextlib.suppress(OSError):
+        os.close(I2C_FD)
+
+
+# Open the I2C bus (device) once, it's held open for the life of the
+# controller and is only closed (at exit) by close_i2c_bus().
+# Do not re-open it - every speed change would cost an open()/close().
+# We write to the fan controller with an I2C_RDWR ioctl.
+I2C_FD: int = os.open(f"/dev/i2c-{BUS_ID}", os.O_RDWR)
+atexit.register(close_i2c_bus)
+# The (pre-allocated) fan control message - the command followed by the speed.
+# Only the speed changes, and we write the whole message in one transaction.
+FAN_CONTROL_BUFFER: ctypes.Array[ctypes.c_uint8] = (ctypes.c_uint8 * 2)(
+    FAN_CONTROL_COMMAND, 0
+)
+FAN_CONTROL_MESSAGE: I2cMsg = I2cMsg(
+    addr=FAN_ADDR, flags=0, len=len(FAN_CONTROL_BUFFER), buf=FAN_CONTROL_BUFFER
+)
+FAN_CONTROL_IOCTL_DATA: I2cRdwrIoctlData = I2cRdwrIoctlData(
+    msgs=ctypes.pointer(FAN_CONTROL_MESSAGE), nmsgs=1
+)
+
+
+def open_cpu_temperature_file() -> int | None:
+    """Opens the CPU temperature file, returning its descriptor
+    (or None if it cannot be opened).
+    """
+    try:
+        return os.open(CPU_TEMPERATURE_FILE, os.O_RDONLY)
+    except OSError:
+        return None
+
+
+def close_cpu_temperature_file() -> None:
+    """Closes the CPU temperature file (if it's open)."""
+    if CPU_TEMPERATURE_FD is not None:
+        # It may already be unusable, and there's nothing we can do about it
+        with contextlib.suppress(OSError):
+            os.close(CPU_TEMPERATURE_FD)
+
+
+# Open the temperature file once (it's read on every measurement).
+# We read it with pread() (from offset 0) rather than re-opening the file.
+CPU_TEMPERATURE_FD: int | None = open_cpu_temperature_file()
+CPU_TEMPERATURE_SIZE: int = 16
+atexit.register(close_cpu_temperature_file)
+
+# If cffi is installed the temperature file is read (and parsed)
+# with libc's pread() and strtol(), using a pre-allocated buffer,
+# so no bytes object is created (and converted) for each measurement.
+# strtol()'s end pointer tells us where the number ended, so (like int())
+# we can reject a read that isn't a number.
+# We use cffi's ABI mode, so there's nothing to compile
+# (which is also why pread()'s off_t is declared as a long).
+LIBC_FFI: Any = None
+LIBC: Any = None
+CPU_TEMPERATURE_BUFFER: Any = None
+CPU_TEMPERATURE_END: Any = None
+if FFI is not None:
+    LIBC_FFI = FFI()
+    LIBC_FFI.cdef(
+        "ssize_t pread(int fd, void *buf, size_t count, long offset);"
+        " long strtol(const char *nptr, char **endptr, int base);"
+    )
+    LIBC = LIBC_FFI.dlopen(None)
+    CPU_TEMPERATURE_BUFFER = LIBC_FFI.new("char[]", CPU_TEMPERATURE_SIZE + 1)
+    CPU_TEMPERATURE_END = LIBC_FFI.new("char **")
 
 # Configure logging
 logging.basicConfig(
@@ -73,187 +224,252 @@ logging.basicConfig(
     datefmt="%Y-%m-%dT%H:%M:%S",
 )
 logger: logging.Logger = logging.getLogger()
+# We don't log process or thread details,
+# so there's no need for the logging module to collect them.
+logging.logProcesses = False
+logging.logThreads = False
+logging.logMultiprocessing = False
 
 
-def set_fan_speed(band: int) -> None:
-    """Sets the fan speed, given a percentage."""
-    global CURRENT_BAND  # pylint: disable=global-statement
-    assert 0 <= band <= HIGHEST_BAND
-
-    if band == CURRENT_BAND:
-        return
+def read_fan_speed() -> int | None:
+    """Reads the (raw) speed the fan controller is currently set to,
+    returning None if it cannot be read.
+    """
+    command: ctypes.Array[ctypes.c_uint8] = (ctypes.c_uint8 * 1)(FAN_CONTROL_COMMAND)
+    speed: ctypes.Array[ctypes.c_uint8] = (ctypes.c_uint8 * 1)()
+    messages: ctypes.Array[I2cMsg] = (I2cMsg * 2)(
+        I2cMsg(addr=FAN_ADDR, flags=0, len=len(command), buf=command),
+        I2cMsg(addr=FAN_ADDR, flags=I2C_M_RD, len=len(speed), buf=speed),
+    )
+    try:
+        fcntl.ioctl(I2C_FD, I2C_RDWR, I2cRdwrIoctlData(msgs=messages, nmsgs=2))
+    except OSError:
+        return None
+    return speed[0]
 
-    speed_percent: int = BAND_SPEED[band]
-    logging.info("Setting fan speed to %s%%", speed_percent)
 
-    speed_int = int(speed_percent * 255 / 100)
-    SMBUS.write_byte_data(FAN_ADDR, FAN_CONTROL_COMMAND, speed_int)
-    CURRENT_BAND = band
+def set_fan_speed(band: int, state: FanState = STATE) -> None:
+    """Sets the fan speed, given a band."""
+    if not 0 <= band <= HIGHEST_BAND:
+        raise ValueError(f"Invalid band ({band})")
 
+    if band == state.band:
+        return
 
-def get_cpu_temperature() -> float | None:
+    # Bands can share a speed (i.e. after the speeds have been corrected)
+    # so there's no need to talk to the fan controller if the speed's unchanged.
+    raw_speed: int = BAND_RAW[band]
+    if raw_speed != state.last_raw:
+        logging.info("Setting fan speed to %s%%", BAND_SPEED[band])
+        FAN_CONTROL_BUFFER[1] = raw_speed
+        fcntl.ioctl(I2C_FD, I2C_RDWR, FAN_CONTROL_IOCTL_DATA)
+        state.last_raw = raw_speed
+    state.band = band
+
+
+def read_cpu_temperature_file(fd: int) -> int:
+    """Reads (and parses) the CPU temperature file using libc (see LIBC),
+    returning the temperature (in milli-degrees Celsius). Like os.pread()
+    and int() it raises OSError if the read fails
+    and ValueError if what's read isn't a temperature.
+    """
+    length: int = LIBC.pread(fd, CPU_TEMPERATURE_BUFFER, CPU_TEMPERATURE_SIZE, 0)
+    if length < 0:
+        raise OSError(LIBC_FFI.errno, os.strerror(LIBC_FFI.errno))
+    if length == 0:
+        raise ValueError("Empty temperature file")
+    CPU_TEMPERATURE_BUFFER[length] = b"\0"
+    temperature_mc: int = LIBC.strtol(CPU_TEMPERATURE_BUFFER, CPU_TEMPERATURE_END, 10)
+    # There must be digits, and nothing but the newline after them
+    end: Any = CPU_TEMPERATURE_END[0]
+    if end == CPU_TEMPERATURE_BUFFER or end[0] not in b"\n\0":
+        raise ValueError("Invalid temperature")
+    return temperature_mc
+
+
+def get_cpu_temperature(state: FanState = STATE) -> int | None:
     """Read the CPU temperature, returning the value
-    as a rounded integer if it can be found.
+    (in milli-degrees Celsius) if it can be found. The thermal zone file is used
+    if it's available, otherwise we fall back to 'vcgencmd'.
     """
-    output = subprocess.check_output(["vcgencmd", "measure_temp"]).decode()
-    if match := re.search(r"temp=([\d\.]+)'C", output):
-        temperature: float = float(match[1])
-        logging.debug("%s%sC", temperature, DEGREE_SIGN)
-        return temperature
+    global CPU_TEMPERATURE_FD  # pylint: disable=global-statement
+
+    if CPU_TEMPERATURE_FD is not None:
+        try:
+            if LIBC is None:
+                raw: bytes = os.pread(CPU_TEMPERATURE_FD, CPU_TEMPERATURE_SIZE, 0)
+                if raw != state.temp_raw:
+                    state.temp_raw_mc = int(raw)
+                    state.temp_raw = raw
+                temperature_mc: int = state.temp_raw_mc
+            else:
+                temperature_mc = read_cpu_temperature_file(CPU_TEMPERATURE_FD)
+        except OSError:
+            # The descriptor is no longer usable (i.e. ENODEV).
+            # Re-open the file and try again (next time).
+            logging.warning("Failed to read %s - re-opening", CPU_TEMPERATURE_FILE)
+            close_cpu_temperature_file()
+            CPU_TEMPERATURE_FD = open_cpu_temperature_file()
+            return None
+        except ValueError:
+            # The content isn't a temperature (i.e. it's empty)
+            logging.warning("Failed to parse %s", CPU_TEMPERATURE_FILE)
+            return None
+        if logger.isEnabledFor(logging.DEBUG):
+            logging.debug("%s%sC", temperature_mc / 1000, DEGREE_SIGN)
+        return temperature_mc
+
+    if VCGENCMD is None:
+        return None
+
+    # The output is always of the form "temp=NN.N'C\n"
+    # so we just slice out the value.
+    output: bytes = subprocess.check_output([VCGENCMD, "measure_temp"])
+    if output.startswith(b"temp=") and (apostrophe := output.find(b"'")) > 5:
+        # (vcgencmd is only a fallback, so there is no need to avoid a float)
+        # If the value isn't a temperature (i.e. "abc", "nan" or "inf")
+        # the read has failed.
+        with contextlib.suppress(ValueError, OverflowError):
+            temperature_mc = round(float(output[5:apostrophe]) * 1000)
+            if logger.isEnabledFor(logging.DEBUG):
+                logging.debug("%s%sC", temperature_mc / 1000, DEGREE_SIGN)
+            return temperature_mc
     return None
 
 
-def calculate_temperature_band(  # pylint: disable=too-many-branches,too-many-statements
-    temperature: float,
-) -> int:
-    """Calculate the new temperature band, given the temperature.
+def calculate_measurement_interval(
+    temperature_mc: int, previous_temperature_mc: int | None, band: int
+) -> float:
+    """Calculate the interval (seconds) to the next measurement, given the
+    temperature and the previous temperature (if there was one),
+    both in milli-degrees Celsius, and the (new) temperature band.
+    """
+    interval_s: float = MEASUREMENT_INTERVAL_S * BAND_INTERVAL_FACTOR[band]
+    if previous_temperature_mc is not None:
+        change_mc: int = abs(temperature_mc - previous_temperature_mc)
+        if change_mc > UNSTABLE_TEMPERATURE_CHANGE_MC:
+            interval_s /= 2
+    # Only the thresholds either side of the temperature can be the nearest
+    bucket: int = bisect_right(TEMPERATURE_BUCKETS_MC, temperature_mc)
+    nearest_mc: int = min(
+        abs(temperature_mc - threshold_mc)
+        for threshold_mc in TEMPERATURE_BUCKETS_MC[max(bucket - 1, 0) : bucket + 1]
+    )
+    if nearest_mc < NEAR_THRESHOLD_MC:
+        interval_s /= 2
+    return min(max(interval_s, MINIMUM_INTERVAL_S), MAXIMUM_INTERVAL_S)
+
+
+def calculate_temperature_band(temperature_mc: int, current_band: int) -> int:
+    """Calculate the new temperature band, given the temperature
+    (in milli-degrees Celsius) and the current band.
     The new band will depend on the current band,
-    the new temperature and hysteresis.
+    the new temperature and hysteresis. This is a pure function,
+    it has no side-effects (the caller logs any change of band).
     """
-    new_band: int = CURRENT_BAND
-    if CURRENT_BAND == 0:
-        # Fan's not running - should it run?
-        if temperature >= TEMPERATURE_POINT_1:
-            new_band = 1
-        elif temperature >= TEMPERATURE_POINT_2:
-            new_band = 2
-        elif temperature >= TEMPERATURE_POINT_3:
-            new_band = 3
-        elif temperature >= TEMPERATURE_POINT_4:
-            new_band = 4
-
-    elif CURRENT_BAND == 1:
-        # Do we need to move up a band?
-        if temperature >= TEMPERATURE_POINT_2:
-            new_band = 2
-        elif temperature >= TEMPERATURE_POINT_3:
-            new_band = 3
-        elif temperature >= TEMPERATURE_POINT_4:
-            new_band = 4
-        # Do we need to move to a lower band (there is only one below us)?
-        if temperature <= TEMPERATURE_POINT_1 - HYSTERESIS:
-            new_band = 0
-
-    elif CURRENT_BAND == 2:
-        # Do we need to move up a band?
-        if temperature >= TEMPERATURE_POINT_3:
-            new_band = 3
-        elif temperature >= TEMPERATURE_POINT_4:
-            new_band = 4
-        # Do we need to move to a lower band?
-        if temperature <= TEMPERATURE_POINT_1 - HYSTERESIS:
-            new_band = 0
-        elif temperature <= TEMPERATURE_POINT_2 - HYSTERESIS:
-            new_band = 1
-
-    elif CURRENT_BAND == 3:
-        # Do we need to move up a band?
-        if temperature >= TEMPERATURE_POINT_4:
-            new_band = 4
-            return 100
-        # Do we need to move to a lower band?
-        if temperature <= TEMPERATURE_POINT_1 - HYSTERESIS:
-            new_band = 0
-        elif temperature <= TEMPERATURE_POINT_2 - HYSTERESIS:
-            new_band = 1
-        elif temperature <= TEMPERATURE_POINT_3 - HYSTERESIS:
-            new_band = 2
+    # The new band is pre-calculated (see TRANSITIONS),
+    # we just need to find the temperature's bucket.
+    bucket: int = bisect_right(TEMPERATURE_BUCKETS_MC, temperature_mc)
+    # (every band in the table is valid, so there's nothing to check)
+    return TRANSITIONS[current_band * TRANSITIONS_PER_BAND + bucket]
 
+
+def measure(state: FanState = STATE) -> float:
+    """Measures the temperature and sets the fan speed,
+    returning the interval (seconds) to the next measurement.
+    This is everything done for a measurement (other than waiting for it).
+    """
+    current_temperature_mc: int | None = get_cpu_temperature(state)
+    if current_temperature_mc is None:
+        logging.info(
+            "Temperature read failed - setting fan speed to %s%%",
+            BAND_SPEED[HIGHEST_BAND],
+        )
+        set_fan_speed(HIGHEST_BAND, state)
+        measurement_interval_s: float = MEASUREMENT_INTERVAL_S
     else:
-        # Band 4 - the highest band
-        if temperature <= TEMPERATURE_POINT_1 - HYSTERESIS:
-            new_band = 0
-        elif temperature <= TEMPERATURE_POINT_2 - HYSTERESIS:
-            new_band = 1
-        elif temperature <= TEMPERATURE_POINT_3 - HYSTERESIS:
-            new_band = 2
-        elif temperature <= TEMPERATURE_POINT_4 - HYSTERESIS:
-            new_band = 3
+        temperature_band: int = calculate_temperature_band(
+            current_temperature_mc, state.band
+        )
+        if temperature_band != state.band:
+            logging.info(
+                "Moving %s from band %d to %d",
+                "up" if temperature_band > state.band else "down",
+                state.band,
+                temperature_band,
+            )
+        set_fan_speed(temperature_band, state)
+        measurement_interval_s = calculate_measurement_interval(
+            current_temperature_mc, state.temp_mc, temperature_band
+        )
+    state.temp_mc = current_temperature_mc
+    return measurement_interval_s
+
 
-    assert 0 <= new_band <= HIGHEST_BAND
-    if new_band != CURRENT_BAND:
-        msg = "Moving up" if new_band > CURRENT_BAND else "Moving down"
-        msg += f" from band {CURRENT_BAND} to {new_band}"
-        logging.info(msg)
+async def monitor() -> None:
+    """Periodically monitors the temperature
+    setting the fan speed using the calculated temperature band.
+    Measurements are scheduled against a (monotonic) deadline, so the time
+    spent measuring does not make them drift.
+    The interval to the next measurement adapts to the temperature.
+    """
+    next_measurement: float = time.monotonic() + MEASUREMENT_INTERVAL_S
+    while True:
+        await asyncio.sleep(next_measurement - time.monotonic())
+
+        measurement_interval_s: float = measure()
 
-    return new_band
+        next_measurement += measurement_interval_s
+        if next_measurement < time.monotonic():
+            # We've fallen behind (i.e. the system was suspended)
+            next_measurement = time.monotonic() + measurement_interval_s
 
 
 logging.info("Running...")
 
 # Correct temperature points.
-# There's a minimum and they must be ordered.
-if TEMPERATURE_POINT_1 < MINIMUM_TEMPERATURE_POINT_VALUE:
-    logger.warning(
-        "TEMPERATURE_POINT_1 too low (%d%s) - setting to %d",
-        TEMPERATURE_POINT_1,
-        DEGREE_SIGN,
-        MINIMUM_TEMPERATURE_POINT_VALUE,
-    )
-    TEMPERATURE_POINT_1 = MINIMUM_TEMPERATURE_POINT_VALUE
-if TEMPERATURE_POINT_2 < TEMPERATURE_POINT_1:
-    logger.warning(
-        "TEMPERATURE_POINT_2 too low (%d%s) - setting to %d",
-        TEMPERATURE_POINT_2,
-        DEGREE_SIGN,
-        TEMPERATURE_POINT_1,
-    )
-    TEMPERATURE_POINT_2 = TEMPERATURE_POINT_1
-if TEMPERATURE_POINT_3 < TEMPERATURE_POINT_2:
-    logger.warning(
-        "TEMPERATURE_POINT_3 too low (%d%s) - setting to %d",
-        TEMPERATURE_POINT_3,
-        DEGREE_SIGN,
-        TEMPERATURE_POINT_2,
+# There's a minimum and they must be ordered,
+# so each point is raised to the minimum or the point below it.
+REQUESTED_TEMPERATURE_POINTS: Tuple[int, ...] = TEMPERATURE_POINTS
+TEMPERATURE_POINTS = tuple(
+    accumulate(
+        REQUESTED_TEMPERATURE_POINTS, max, initial=MINIMUM_TEMPERATURE_POINT_VALUE
     )
-    TEMPERATURE_POINT_3 = TEMPERATURE_POINT_2
-if TEMPERATURE_POINT_4 < TEMPERATURE_POINT_3:
-    logger.warning(
-        "TEMPERATURE_POINT_4 too low (%d%s) - setting to %d",
-        TEMPERATURE_POINT_4,
-        DEGREE_SIGN,
-        TEMPERATURE_POINT_3,
-    )
-    TEMPERATURE_POINT_4 = TEMPERATURE_POINT_3
+)[1:]
+for index, (requested, corrected) in enumerate(
+    zip(REQUESTED_TEMPERATURE_POINTS, TEMPERATURE_POINTS)
+):
+    if corrected != requested:
+        logger.warning(
+            "TEMPERATURE_POINT_%d too low (%d%s) - setting to %d",
+            index + 1,
+            requested,
+            DEGREE_SIGN,
+            corrected,
+        )
 
 # Correct band speeds.
-# There's a minimum and they must be ordered.
-if BAND_SPEED[0] < MINIMUM_FAN_SPEED_PERCENT:
-    logger.warning(
-        "BAND_SPEED[0] too low (%d%%) - setting to %d",
-        BAND_SPEED[0],
-        MINIMUM_FAN_SPEED_PERCENT,
-    )
-    BAND_SPEED[0] = MINIMUM_FAN_SPEED_PERCENT
-if BAND_SPEED[1] < BAND_SPEED[0]:
-    logger.warning(
-        "BAND_SPEED[1] too low (%d%%) - setting to %d", BAND_SPEED[1], BAND_SPEED[0]
-    )
-    BAND_SPEED[1] = BAND_SPEED[0]
-if BAND_SPEED[2] < BAND_SPEED[1]:
-    logger.warning(
-        "BAND_SPEED[2] too low (%d%%) - setting to %d", BAND_SPEED[2], BAND_SPEED[1]
-    )
-    BAND_SPEED[2] = BAND_SPEED[1]
-if BAND_SPEED[3] < BAND_SPEED[2]:
-    logger.warning(
-        "BAND_SPEED[3] too low (%d%%) - setting to %d", BAND_SPEED[3], BAND_SPEED[2]
-    )
-    BAND_SPEED[3] = BAND_SPEED[2]
-if BAND_SPEED[4] < BAND_SPEED[3]:
-    logger.warning(
-        "BAND_SPEED[4] too low (%d%%) - setting to %d", BAND_SPEED[4], BAND_SPEED[3]
-    )
-    BAND_SPEED[4] = BAND_SPEED[3]
+# There's a minimum and they must be ordered,
+# so each speed is raised to the minimum or the speed below it.
+REQUESTED_BAND_SPEED: Tuple[int, ...] = BAND_SPEED
+BAND_SPEED = tuple(
+    accumulate(REQUESTED_BAND_SPEED, max, initial=MINIMUM_FAN_SPEED_PERCENT)
+)[1:]
+for index, (requested, corrected) in enumerate(zip(REQUESTED_BAND_SPEED, BAND_SPEED)):
+    if corrected != requested:
+        logger.warning(
+            "BAND_SPEED[%d] too low (%d%%) - setting to %d", index, requested, corrected
+        )
+
+# The (fixed) raw fan controller value (0..255) for each band,
+# calculated once rather than every time the fan speed is set.
+BAND_RAW: Tuple[int, ...] = tuple((speed * 255) // 100 for speed in BAND_SPEED)
 
 # Check hysteresis (must be less than the minimum width of the bands).
-SMALLEST_BAND_WIDTH: int = MINIMUM_TEMPERATURE_POINT_VALUE
-if TEMPERATURE_POINT_2 - TEMPERATURE_POINT_1 < SMALLEST_BAND_WIDTH:
-    SMALLEST_BAND_WIDTH = TEMPERATURE_POINT_2 - TEMPERATURE_POINT_1
-elif TEMPERATURE_POINT_3 - TEMPERATURE_POINT_2 < SMALLEST_BAND_WIDTH:
-    SMALLEST_BAND_WIDTH = TEMPERATURE_POINT_3 - TEMPERATURE_POINT_2
-elif TEMPERATURE_POINT_4 - TEMPERATURE_POINT_3 < SMALLEST_BAND_WIDTH:
-    SMALLEST_BAND_WIDTH = TEMPERATURE_POINT_4 - TEMPERATURE_POINT_3
+SMALLEST_BAND_WIDTH: int = min(
+    MINIMUM_TEMPERATURE_POINT_VALUE,
+    *(upper - lower for lower, upper in pairwise(TEMPERATURE_POINTS)),
+)
 # We must have a minimum bandwidth of 5 degrees if hysteresis is going to make any sense.
 if HYSTERESIS > SMALLEST_BAND_WIDTH - 2:
     CHOSEN_HYSTERESIS: int = 2 if SMALLEST_BAND_WIDTH >= 5 else 0
@@ -267,6 +483,42 @@ if HYSTERESIS > SMALLEST_BAND_WIDTH - 2:
     )
     HYSTERESIS = CHOSEN_HYSTERESIS
 
+# The (fixed) temperature thresholds used to calculate the temperature band.
+# We move up to a band when the temperature reaches its temperature point
+# and down from it when the temperature falls to its point less hysteresis.
+# Temperatures are measured in milli-degrees, so the thresholds are too
+# (keeping the measurements integers).
+UP_THRESHOLDS_MC: Tuple[int, ...] = tuple(point * 1000 for point in TEMPERATURE_POINTS)
+DOWN_THRESHOLDS_MC: Tuple[int, ...] = tuple(
+    (point - HYSTERESIS) * 1000 for point in TEMPERATURE_POINTS
+)
+
+# The temperature buckets, i.e. the temperatures at which a band can change.
+# As we move down when the temperature is at (or below) a downward threshold
+# a new bucket starts 1 milli-degree above it.
+TEMPERATURE_BUCKETS_MC: Tuple[int, ...] = tuple(
+    sorted(set(UP_THRESHOLDS_MC) | {point + 1 for point in DOWN_THRESHOLDS_MC})
+)
+# The new band for every band and temperature bucket, indexed by
+# '(band * TRANSITIONS_PER_BAND) + bucket' (where bucket 0 is below all the
+# thresholds). For a temperature in the bucket (we use its lowest value)
+# the temperature forces us up to (at least) 'up_band'
+# (the number of temperature points it has reached)
+# and permits us to stay as high as 'down_band'
+# (the number of temperature points, less hysteresis, it's still above).
+# So, if we're below 'up_band' we move up to it,
+# if we're above 'down_band' we move down to it,
+# otherwise we stay in the current band.
+TRANSITIONS_PER_BAND: int = len(TEMPERATURE_BUCKETS_MC) + 1
+TRANSITIONS: Tuple[int, ...] = tuple(
+    max(
+        bisect_right(UP_THRESHOLDS_MC, temperature_mc),
+        min(band, bisect_left(DOWN_THRESHOLDS_MC, temperature_mc)),
+    )
+    for band in range(HIGHEST_BAND + 1)
+    for temperature_mc in (TEMPERATURE_BUCKETS_MC[0] - 1, *TEMPERATURE_BUCKETS_MC)
+)
+
 # Correct measurement interval (there is a minium and a maximum).
 if MEASUREMENT_INTERVAL_S < MINIMUM_INTERVAL_S:
     logger.warning(
@@ -295,10 +547,10 @@ logging.info("MEASUREMENT_INTERVAL_S=%d seconds", MEASUREMENT_INTERVAL_S)
 logging.info("HYSTERESIS=%d%s", HYSTERESIS, DEGREE_SIGN)
 logging.info(
     "TEMPERATURE_POINTS (degrees celsius) %d|%d|%d|%d",
-    TEMPERATURE_POINT_1,
-    TEMPERATURE_POINT_2,
-    TEMPERATURE_POINT_3,
-    TEMPERATURE_POINT_4,
+    TEMPERATURE_POINTS[0],
+    TEMPERATURE_POINTS[1],
+    TEMPERATURE_POINTS[2],
+    TEMPERATURE_POINTS[3],
 )
 logging.info(
     "BAND_SPEEDS (percent) %d|%d|%d|%d|%d",
@@ -309,23 +561,13 @@ logging.info(
     BAND_SPEED[4],
 )
 
-# At startup always start the fan for the highest band
+# At startup always start the fan for the highest band.
+# If we can read the fan controller's current speed
+# we'll only write the speed if it needs to change.
+if (fan_speed := read_fan_speed()) is not None:
+    STATE.last_raw = fan_speed
 set_fan_speed(HIGHEST_BAND)
 
 # Now periodically monitor the temperature
-# setting the fan speed using the calculated temperature band.
-while True:
-    time.sleep(MEASUREMENT_INTERVAL_S)
-
-    current_temperature: float | None = get_cpu_temperature()
-    if current_temperature is None:
-        logging.info(
-            "Temperature read failed - setting fan speed to %s%%",
-            BAND_SPEED[HIGHEST_BAND],
-        )
-        set_fan_speed(HIGHEST_BAND)
-        continue
-
-    temperature_band: int = calculate_temperature_band(current_temperature)
-    assert 0 <= temperature_band <= HIGHEST_BAND
-    set_fan_speed(temperature_band)
+# (until we're stopped).
+asyncio.run(monitor())